@@ -1,26 +1,71 @@
+import hashlib
+import io
+import json
 import re
+import uuid
+import zipfile
+from xml.etree import ElementTree
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import streamlit as st
 import google.generativeai as genai
-import docx2txt
-import PyPDF2
-import pandas as pd
+from google.api_core.exceptions import ResourceExhausted
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
 from datetime import datetime
 
+try:
+    # RE2 guarantees linear-time matching on long resume text
+    import re2 as scan_re
+except ImportError:
+    scan_re = re
+
 # --- Gemini Setup ---
 if "GEMINI_API_KEY" not in st.secrets:
     st.error("API key missing! Add to Streamlit Secrets.")
     st.stop()
 
 genai.configure(api_key=st.secrets["GEMINI_API_KEY"])
-model = genai.GenerativeModel('gemini-1.5-pro-latest')
+OUTPUT_TOKENS_PER_RESUME = 512
+# Flash is plenty for structured scoring; low temperature keeps scores stable
+model = genai.GenerativeModel(
+    'gemini-1.5-flash-latest',
+    generation_config=genai.types.GenerationConfig(
+        temperature=0.1,
+        top_p=0.9,
+        max_output_tokens=OUTPUT_TOKENS_PER_RESUME,
+        response_mime_type="application/json"
+    )
+)
 
 # --- Initialize Session State ---
 if 'jd_text' not in st.session_state:
     st.session_state.jd_text = ""
+if 'jd_file_id' not in st.session_state:
+    st.session_state.jd_file_id = None
 if 'candidates' not in st.session_state:
     st.session_state.candidates = []
+if 'candidates_by_name' not in st.session_state:
+    st.session_state.candidates_by_name = {}
+if 'candidates_version' not in st.session_state:
+    st.session_state.candidates_version = ""
 
 # --- Enhanced Parser Functions ---
+NAME_RE = re.compile(r"^(.*?)\n")
+# Email, phone (US/International formats) and LinkedIn in one pass.
+# ASCII-only \d/\w classes are cheaper; RE2's classes are ASCII already
+CONTACT_RE = scan_re.compile(
+    (r'(?a)' if scan_re is re else r'') +
+    r'(?P<email>[\w\.-]+@[\w\.-]+)'
+    r'|(?P<phone>(?:\+?\d{1,3}[-\.\s]?)?\(?\d{3}\)?[-\.\s]?\d{3}[-\.\s]?\d{4})'
+    # Explicit slug class: ASCII-only \s would run past non-breaking spaces
+    r'|(?P<linkedin>(?:https?://)?(?:www\.)?linkedin\.com/in/[A-Za-z0-9_%./-]+)'
+)
+CONTACT_FIELDS = ("email", "phone", "linkedin")
+SECTION_HEADERS = {
+    "education": scan_re.compile(r'(?i)\b(Education|Academic Background)\b'),
+}
+INSTITUTION_RE = scan_re.compile(r'(?i)[^\n]*(University|College|Institute)[^\n]*')
+SECTION_WINDOW = 500
+
 def extract_personal_details(text):
     details = {
         "name": "N/A",
@@ -31,82 +76,274 @@ def extract_personal_details(text):
     }
     
     # Name (First 2 lines usually contain name)
-    name_match = re.search(r"^(.*?)\n", text[:200])
+    name_match = NAME_RE.search(text[:200])
     if name_match:
         details["name"] = name_match.group(1).strip()
     
-    # Email
-    email_match = re.search(r'[\w\.-]+@[\w\.-]+', text)
-    if email_match:
-        details["email"] = email_match.group(0)
-    
-    # Phone (US/International formats)
-    phone_match = re.search(r'(\+?\d{1,3}[-\.\s]?)?\(?\d{3}\)?[-\.\s]?\d{3}[-\.\s]?\d{4}', text)
-    if phone_match:
-        details["phone"] = phone_match.group(0)
-    
-    # LinkedIn
-    linkedin_match = re.search(r'(https?://)?(www\.)?linkedin\.com/in/[^\s]+', text)
-    if linkedin_match:
-        details["linkedin"] = linkedin_match.group(0)
+    # Contacts (first match of each kind wins; stop once all are found)
+    found = 0
+    for match in CONTACT_RE.finditer(text):
+        if details[match.lastgroup] == "N/A":
+            details[match.lastgroup] = match.group()
+            found += 1
+            if found == len(CONTACT_FIELDS):
+                break
     
     # Education (Extract most prominent university)
-    education_match = re.search(r'(Education|Academic Background)[\s\S]*?(University|College|Institute)[^\n]+', text, re.IGNORECASE)
+    # Scan a bounded window after the header instead of backtracking the whole text
+    header_match = SECTION_HEADERS["education"].search(text)
+    education_match = header_match and INSTITUTION_RE.search(
+        text, header_match.end(), header_match.end() + SECTION_WINDOW
+    )
     if education_match:
         details["education"] = education_match.group(0).replace("\n", " ").strip()[:100]
     
     return details
 
-def extract_text(file):
-    if file.type == "application/pdf":
-        reader = PyPDF2.PdfReader(file)
-        text = " ".join(page.extract_text() for page in reader.pages if page.extract_text())
-    elif file.type.endswith('document'):
-        text = docx2txt.process(file)
+def text_hash(text):
+    return hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+
+WORD_NS = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+WORD_BREAKS = {WORD_NS + "br": "\n", WORD_NS + "cr": "\n", WORD_NS + "tab": "\t"}
+HEADER_PART_RE = re.compile(r'word/header\d*\.xml')
+FOOTER_PART_RE = re.compile(r'word/footer\d*\.xml')
+
+def _docx_text(data):
+    # Stream <w:t> runs straight out of the XML parts, one line per paragraph.
+    # Headers come first, as in docx2txt, since resumes often put contacts there
+    parts = []
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        names = archive.namelist()
+        part_names = (
+            [n for n in names if HEADER_PART_RE.fullmatch(n)]
+            + ["word/document.xml"]
+            + [n for n in names if FOOTER_PART_RE.fullmatch(n)]
+        )
+        for part_name in part_names:
+            with archive.open(part_name) as xml:
+                for _, elem in ElementTree.iterparse(xml):
+                    if elem.tag == WORD_NS + "t":
+                        parts.append(elem.text or "")
+                    elif elem.tag in WORD_BREAKS:
+                        parts.append(WORD_BREAKS[elem.tag])
+                    elif elem.tag == WORD_NS + "p":
+                        parts.append("\n")
+                        elem.clear()
+    return "".join(parts)
+
+@st.cache_data(show_spinner=False)
+def _parse_bytes(data: bytes, mime: str) -> tuple[str, dict]:
+    # Cached on file contents so re-uploads skip parsing entirely
+    if mime == "application/pdf":
+        import pymupdf  # imported lazily to keep reruns fast
+        with pymupdf.open(stream=data, filetype="pdf") as doc:
+            # One get_text call per page; blank pages are skipped
+            text = chr(12).join(t for page in doc if (t := page.get_text("text")))
+    elif mime.endswith('document'):
+        text = _docx_text(data)
     else:
-        text = file.read().decode()
+        text = data.decode()
     
     personal_details = extract_personal_details(text)
     return text, personal_details
 
+def extract_text(file):
+    return _parse_bytes(file.getvalue(), file.type)
+
 # --- Improved Analysis Function ---
-def analyze_resume(jd, resume_text):
+MAX_INPUT_TOKENS = 4000
+# Whole-prompt budget (JD included); below RESUMES_PER_CALL * MAX_INPUT_TOKENS
+MAX_BATCH_TOKENS = 16000
+RESUMES_PER_CALL = 5
+
+# Back off and retry when Gemini rate-limits us (HTTP 429)
+with_backoff = retry(
+    wait=wait_exponential(multiplier=1, min=2, max=30),
+    retry=retry_if_exception_type(ResourceExhausted),
+    stop=stop_after_attempt(5),
+    reraise=True
+)
+
+class OutputTruncated(Exception):
+    """Gemini stopped at max_output_tokens, so the JSON is incomplete."""
+
+@with_backoff
+def generate_with_backoff(prompt, generation_config=None):
+    return model.generate_content(prompt, generation_config=generation_config)
+
+@st.cache_data(show_spinner=False)
+@with_backoff
+def count_tokens(text):
+    # Raises on failure, so only real counts are ever cached
+    return model.count_tokens(text).total_tokens
+
+CHARS_PER_TOKEN = 4  # rough estimate for English text
+
+def truncate_to_tokens(text, max_tokens=MAX_INPUT_TOKENS) -> tuple[str, int]:
+    # Every token covers at least one UTF-8 byte, so short texts need no
+    # count_tokens call; the count fed to the chunk budget is then an estimate
+    if len(text.encode()) <= max_tokens:
+        return text, len(text) // CHARS_PER_TOKEN + 1
+    try:
+        total = count_tokens(text)
+    except Exception:
+        # Uncached guess; the next batch will try counting again. Bounding by
+        # bytes keeps non-ASCII text (several bytes per char) from overshooting
+        budget = max_tokens * CHARS_PER_TOKEN
+        return text.encode()[:budget].decode(errors="ignore"), max_tokens
+    if total <= max_tokens:
+        return text, total
+    # Slice at the observed chars-per-token ratio
+    return text[:len(text) * max_tokens // total], max_tokens
+
+def chunk_resumes(token_counts, max_per_call=RESUMES_PER_CALL, max_tokens=MAX_BATCH_TOKENS):
+    # Greedily group resume indices so each Gemini call stays within budget
+    chunks, current, used = [], [], 0
+    for i, tokens in enumerate(token_counts):
+        if current and (len(current) == max_per_call or used + tokens > max_tokens):
+            chunks.append(current)
+            current, used = [], 0
+        current.append(i)
+        used += tokens
+    if current:
+        chunks.append(current)
+    return chunks
+
+ANALYSIS_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "id": {"type": "integer"},
+        "score": {"type": "integer"},
+        "skill_matches": {"type": "array", "items": {"type": "string"}},
+        "missing_requirements": {"type": "array", "items": {"type": "string"}},
+        "experience_analysis": {"type": "string"},
+        "summary": {"type": "string"}
+    },
+    "required": ["id", "score", "skill_matches", "missing_requirements", "experience_analysis", "summary"]
+}
+
+BATCH_SCHEMA = {"type": "array", "items": ANALYSIS_SCHEMA}
+
+@st.cache_data(show_spinner=False)
+def _score_resumes(jd_hash, resume_keys, _jd, _texts):
+    # Keyed on the text hashes only; raises on failure so errors aren't cached.
+    # Prompt ids are short 1-based ordinals so the model can echo them cheaply
+    resume_block = "\n".join(f"[{n}] {text}" for n, text in enumerate(_texts, start=1))
     prompt = f"""
-    As a senior recruiter, analyze this resume against the job description.
-    Calculate a match score (0-100) based on:
+    As a senior recruiter, analyze each resume against the job description.
+    Calculate a match score (0-100) for each based on:
     - Required skills match (50% weight)
     - Years of relevant experience (30% weight)
     - Education/certifications (20% weight)
 
-    Return STRICT JSON format:
-    {{
+    Return a STRICT JSON array with one object per resume, using the
+    bracketed resume number as "id". Keep it brief: at most 5 short
+    items per list and 1-2 sentences for each text field.
+    [{{
+        "id": 1,
         "score": 0-100,
         "skill_matches": [],
         "missing_requirements": [],
         "experience_analysis": "",
         "summary": ""
-    }}
+    }}]
 
-    Job Description:
-    {jd[:5000]}
+    JD:
+    {_jd}
 
-    Resume:
-    {resume_text[:5000]}
+    Resumes:
+    {resume_block}
     """
+    # Merged over the model defaults; output budget scales with the chunk size
+    response = generate_with_backoff(prompt, {
+        "response_schema": BATCH_SCHEMA,
+        "max_output_tokens": OUTPUT_TOKENS_PER_RESUME * len(_texts)
+    })
+    if response.candidates and response.candidates[0].finish_reason.name == "MAX_TOKENS":
+        raise OutputTruncated()
+    # Gemini returns schema-conforming JSON, no markdown fences to strip
+    return json.loads(response.text)
+
+def failed_analysis(error):
+    return {
+        "error": f"Analysis error: {error}",
+        "score": 0,
+        "skill_matches": [],
+        "missing_requirements": [],
+        "experience_analysis": "Analysis failed",
+        "summary": "Could not evaluate"
+    }
+
+def analyze_resumes_batch(jd, resumes: list[tuple[str, str]]) -> list[dict]:
+    # Score several resumes in one call so the JD is only sent once.
+    # Resume ids are text hashes and form the cache key, not the prompt ids
+    resume_keys = tuple(resume_id for resume_id, _ in resumes)
     try:
-        response = model.generate_content(prompt)
-        # Clean response and parse JSON
-        json_str = response.text.strip().replace('```json', '').replace('```', '').strip()
-        return json.loads(json_str)
+        results = _score_resumes(text_hash(jd), resume_keys, jd, [text for _, text in resumes])
+        if not isinstance(results, list):
+            raise ValueError("expected a JSON array of analyses")
+        # Map the 1-based prompt ordinals back to chunk positions
+        by_position = {}
+        for r in results:
+            if isinstance(r, dict) and isinstance(r.get("id"), int):
+                by_position[r.pop("id") - 1] = r
+    except OutputTruncated:
+        if len(resumes) == 1:
+            return [failed_analysis("response exceeded the output token limit")]
+        # Retry each half with its own, smaller prompt
+        half = len(resumes) // 2
+        return analyze_resumes_batch(jd, resumes[:half]) + analyze_resumes_batch(jd, resumes[half:])
     except Exception as e:
-        st.error(f"Analysis error: {str(e)}")
-        return {
-            "score": 0,
-            "skill_matches": [],
-            "missing_requirements": [],
-            "experience_analysis": "Analysis failed",
-            "summary": "Could not evaluate"
-        }
+        # Runs in a worker thread, so the caller reports the error
+        return [failed_analysis(str(e)) for _ in resumes]
+    
+    return [
+        by_position.get(position) or failed_analysis("no result returned for a resume")
+        for position in range(len(resumes))
+    ]
+
+# --- Dashboard Helpers ---
+# Each batch gets a fresh version key, so bound the shared cross-session caches
+DASHBOARD_CACHE_ENTRIES = 32
+
+@st.cache_data(show_spinner=False, max_entries=DASHBOARD_CACHE_ENTRIES)
+def build_candidate_df(candidates_version, _candidates):
+    # Keyed on candidates_version, which is replaced whenever candidates change
+    import pandas as pd
+    
+    # Built column-wise so pandas skips the rows-to-columns transposition
+    df = pd.DataFrame({
+        "Name": [c["name"] for c in _candidates],
+        "Email": [c["email"] for c in _candidates],
+        "Match Score": [c["score"] for c in _candidates],
+        "Top Skills": [", ".join(c["skill_matches"][:3]) for c in _candidates],
+        "Missing": [", ".join(c["missing_requirements"][:3]) for c in _candidates],
+        "Education": [c["education"] for c in _candidates]
+    })
+    
+    return df.sort_values("Match Score", ascending=False)
+
+XLSX_EXPORT_MAX_ROWS = 500
+
+@st.cache_data(show_spinner=False, max_entries=DASHBOARD_CACHE_ENTRIES)
+def build_candidate_csv(candidates_version, _df):
+    return _df.to_csv(index=False).encode()
+
+@st.cache_data(show_spinner=False, max_entries=DASHBOARD_CACHE_ENTRIES)
+def build_candidate_xlsx(candidates_version, _df):
+    from openpyxl import Workbook
+    from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+    
+    # write_only streams rows out instead of building the full sheet in memory
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Candidates")
+    ws.append(list(_df.columns))
+    for row in _df.itertuples(index=False):
+        # Control chars from parsed text (e.g. \f page breaks) are illegal in xlsx
+        ws.append([ILLEGAL_CHARACTERS_RE.sub("", v) if isinstance(v, str) else v for v in row])
+    buffer = io.BytesIO()
+    wb.save(buffer)
+    return buffer.getvalue()
 
 # --- UI Flow ---
 st.set_page_config(layout="wide", page_title="RecruitAI Pro")
@@ -116,7 +353,10 @@ st.title("🚀 RecruitAI Pro - Smart Matching")
 st.subheader("📋 1. Upload Job Description")
 jd_file = st.file_uploader("Upload JD (PDF/DOCX)", type=["pdf","docx"], key="jd_uploader")
 if jd_file:
-    st.session_state.jd_text, _ = extract_text(jd_file)
+    # Only copy and hash the upload's bytes when a new JD file arrives
+    if jd_file.file_id != st.session_state.jd_file_id:
+        st.session_state.jd_text, _ = extract_text(jd_file)
+        st.session_state.jd_file_id = jd_file.file_id
     with st.expander("View Parsed JD"):
         st.write(st.session_state.jd_text[:2000] + "...")
 
@@ -124,46 +364,70 @@ if jd_file:
 if st.session_state.jd_text:
     st.subheader("📚 2. Upload Resumes (Batch)")
     resumes = st.file_uploader("Upload Multiple Resumes", type=["pdf","docx","txt"], accept_multiple_files=True)
+    max_workers = st.slider("Parallel Gemini requests", min_value=1, max_value=16, value=8)
     
     if resumes and st.button("Analyze Batch"):
-        st.session_state.candidates = []
         progress_bar = st.progress(0)
         
-        for i, resume in enumerate(resumes):
-            progress_bar.progress((i+1)/len(resumes))
-            text, details = extract_text(resume)
-            analysis = analyze_resume(st.session_state.jd_text, text)
-            
-            if analysis:
-                candidate = {
-                    **details,
-                    **analysis,
-                    "resume_text": text[:500] + "..."
-                }
-                st.session_state.candidates.append(candidate)
+        # Parse files on the main thread, then fan out the Gemini calls
+        parsed = [extract_text(resume) for resume in resumes]
+        jd, jd_tokens = truncate_to_tokens(st.session_state.jd_text)
+        errors = set()
+        done = 0
+        # One slot per upload, filled as chunks complete, so upload order is kept
+        candidates = [None] * len(resumes)
+        
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            trimmed = list(executor.map(truncate_to_tokens, [text for text, _ in parsed]))
+            # Content-hash ids keep each chunk's cache key stable across re-uploads
+            resume_ids = [text_hash(text) for text, _ in trimmed]
+            chunks = chunk_resumes(
+                [tokens for _, tokens in trimmed],
+                max_tokens=MAX_BATCH_TOKENS - jd_tokens
+            )
+            futures = {
+                executor.submit(analyze_resumes_batch, jd, [(resume_ids[i], trimmed[i][0]) for i in chunk]): chunk
+                for chunk in chunks
+            }
+            for future in as_completed(futures):
+                for i, analysis in zip(futures[future], future.result()):
+                    done += 1
+                    progress_bar.progress(done/len(resumes))
+                    text, details = parsed[i]
+                    
+                    if "error" in analysis:
+                        errors.add(analysis.pop("error"))
+                    
+                    candidates[i] = {
+                        **details,
+                        **analysis,
+                        "resume_text": text[:500] + "..."
+                    }
+        
+        st.session_state.candidates = [c for c in candidates if c is not None]
+        # First candidate wins on duplicate names, as with the old linear scan
+        st.session_state.candidates_by_name = {
+            c['name']: c for c in reversed(st.session_state.candidates)
+        }
+        # st.cache_data is shared across sessions, so the version must be unique
+        st.session_state.candidates_version = uuid.uuid4().hex
+        
+        for error in errors:
+            st.error(error)
 
 # --- Step 3: Enhanced Dashboard ---
-if st.session_state.candidates:
+@st.fragment
+def dashboard():
+    # Fragment scope: dashboard widgets rerun only this function, not the page
     st.divider()
     st.subheader("👥 Candidate Evaluation Dashboard")
     
     # Create DataFrame with all details
-    df_data = []
-    for c in st.session_state.candidates:
-        df_data.append({
-            "Name": c["name"],
-            "Email": c["email"],
-            "Match Score": c["score"],
-            "Top Skills": ", ".join(c["skill_matches"][:3]),
-            "Missing": ", ".join(c["missing_requirements"][:3]),
-            "Education": c["education"]
-        })
-    
-    df = pd.DataFrame(df_data)
+    df = build_candidate_df(st.session_state.candidates_version, st.session_state.candidates)
     
     # Interactive table
     st.dataframe(
-        df.sort_values("Match Score", ascending=False),
+        df,
         column_config={
             "Match Score": st.column_config.ProgressColumn(
                 "Match Score",
@@ -177,9 +441,36 @@ if st.session_state.candidates:
         use_container_width=True
     )
     
+    # Export (CSV is the fast path; xlsx only for smaller batches)
+    export_name = f"candidates_{datetime.now().date()}"
+    col_csv, col_xlsx = st.columns(2)
+    with col_csv:
+        st.download_button(
+            "📥 Export to CSV",
+            build_candidate_csv(st.session_state.candidates_version, df),
+            file_name=f"{export_name}.csv",
+            mime="text/csv"
+        )
+    with col_xlsx:
+        if len(df) <= XLSX_EXPORT_MAX_ROWS:
+            # A failed workbook must not take the rest of the dashboard down
+            try:
+                xlsx_data = build_candidate_xlsx(st.session_state.candidates_version, df)
+            except Exception as e:
+                st.caption(f"Excel export unavailable ({e}); use CSV instead.")
+            else:
+                st.download_button(
+                    "📥 Export to Excel",
+                    xlsx_data,
+                    file_name=f"{export_name}.xlsx",
+                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+                )
+        else:
+            st.caption(f"Excel export is limited to {XLSX_EXPORT_MAX_ROWS} candidates; use CSV for larger batches.")
+    
     # Candidate Details Section
     selected_name = st.selectbox("View full details", df['Name'])
-    candidate = next(c for c in st.session_state.candidates if c['name'] == selected_name)
+    candidate = st.session_state.candidates_by_name[selected_name]
     
     col1, col2 = st.columns(2)
     with col1:
@@ -206,3 +497,6 @@ if st.session_state.candidates:
     
     st.markdown("**📄 Summary:**")
     st.write(candidate['summary'])
+
+if st.session_state.candidates:
+    dashboard()